@@ -18,6 +18,24 @@ def fill_outpaint_area(image, outpaint_sizes, color, is_mask=False):
     else:
         return fill_with_color(new_image, outpaint_sizes, color)
 
+def fill_outpaint_area_with_mask(image, outpaint_sizes, color, mask_color):
+    """
+    Like fill_outpaint_area, but builds the filled image and its mask in a single
+    call, sharing the padded geometry. Returns (filled_image, mask).
+    """
+    original_width, original_height = image.size
+    new_size = (original_width + outpaint_sizes["right"] + outpaint_sizes["left"], original_height + outpaint_sizes["up"] + outpaint_sizes["down"])
+
+    new_image = Image.new("RGB", new_size, "black")
+    paste_position = (outpaint_sizes["left"], outpaint_sizes["up"])
+    new_image.paste(image, paste_position)
+    mask = fill_with_color(Image.new("RGB", new_size, "white"), outpaint_sizes, mask_color)
+
+    if color == 'patch':
+        return fill_with_patchmatch(new_image, outpaint_sizes), mask
+    else:
+        return fill_with_color(new_image, outpaint_sizes, color), mask
+
 def patchmatch(image, mask):
     if patch_match.patchmatch_available:
         start_time = time.time() * 1000  # Get the current time in milliseconds
@@ -38,30 +56,27 @@ def fill_with_patchmatch(image, outpaint_sizes):
 
     mask = Image.new("L", image.size, 0)  # Entirely black
 
+    # patchmatch treats every masked pixel as unknown, so a single run over
+    # the union of the outpaint areas gives the same result as one run per side
     if outpaint_sizes["left"] != 0:
         mask_area = (0, 0, outpaint_sizes["left"], original_height)
         mask.paste(255, mask_area)  # White in the area to be outpainted
-        image = patchmatch(image, mask)
-        original_width, original_height = image.size
-        
+
     if outpaint_sizes["right"] != 0:
         mask_area = (original_width - outpaint_sizes["right"], 0, original_width, original_height)
         mask.paste(255, mask_area)
-        image = patchmatch(image, mask)
-        original_width, original_height = image.size
-        
+
     if outpaint_sizes["down"] != 0:
         mask_area = (0, original_height - outpaint_sizes["down"], original_width, original_height)
         mask.paste(255, mask_area)
-        image = patchmatch(image, mask)
-        original_width, original_height = image.size
-        
+
     if outpaint_sizes["up"] != 0:
         mask_area = (0, 0, original_width, outpaint_sizes["up"])
         mask.paste(255, mask_area)
-        image = patchmatch(image, mask)
-   
-    return image
+
+    if mask.getbbox() is None:
+        return image
+    return patchmatch(image, mask)
 
 def fill_with_color(image, outpaint_sizes, color):
 